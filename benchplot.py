@@ -8,12 +8,14 @@ Author        Dimitar Misev
 """
 
 from matplotlib import pyplot as plt
-import matplotlib
-import math
+import numpy as np
 import argparse
 import csv
+import hashlib
+import os
+import pickle
 import sys
-import re
+import tempfile
 
 COLORS = ['black', 'red', 'gold', 'green', 'blue', 'magenta',
           'cyan', 'gray', 'darkorange', 'navy', 'violet', 'lime', 'pink']
@@ -37,12 +39,21 @@ COL_CPU_OFFSET = 9
 HAS_STDDEV = False
 NUM_STATS = 3
 
+CSV_BUFFER_SIZE = 1 << 20
+
+# parsed csv files are cached here, so that re-plotting unchanged results
+# (e.g. to tweak the labels) does not parse them again
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or
+                         os.path.expanduser("~/.cache"), "benchplot")
+# bump whenever the format of the cached PlotLine objects changes
+CACHE_VERSION = 2
+
 OFFSET_STATS = {COL_MEAN: 0, COL_MEDIAN: 1, COL_MIN: 2, COL_STDDEV: 3}
 OFFSET_MEASUREMENTS = {COL_ALL: 0, COL_TIME: 0, COL_MEMORY: 1, COL_CPU: 2}
 
 
 def exit_with_error(msg):
-    print >> sys.stderr, msg
+    print(msg, file=sys.stderr)
     sys.exit(1)
 
 
@@ -50,21 +61,21 @@ class PlotLine:
     """
     A line on a plot has data values, label of y axis, and tick labels on x axis
     """
-    def __init__(self, ylabel):
-        self.data = []
-        self.stddev = []
+    def __init__(self, ylabel, size=0):
+        self.data = np.empty(size, dtype=np.float64)
+        self.stddev = np.empty(0, dtype=np.float64)
         self.ylabel = ylabel
         self.isMean = "mean" in self.ylabel.lower()
         self.xtick_labels = []
 
-    def append(self, data_value, xtick_label, stddev_value=None):
-        self.data.append(data_value)
-        if "." in xtick_label:
-            xtick_label = xtick_label[:xtick_label.rfind(".")]
-        xtick_label = re.sub(r'^0+', '', xtick_label) # remove leading zeros
-        self.xtick_labels.append(xtick_label)
-        if stddev_value is not None:
-            self.stddev.append(stddev_value)
+
+def get_xtick_label(benchmark_name):
+    """
+    Turn a benchmark name into an x tick label, e.g. 001.query.sql -> 1.query
+    """
+    if "." in benchmark_name:
+        benchmark_name = benchmark_name[:benchmark_name.rfind(".")]
+    return benchmark_name.lstrip('0') # remove leading zeros
 
 
 class ColSpec:
@@ -83,98 +94,173 @@ class ColSpec:
                              of mean, median, or min.")
         self.measurement = measurement
         self.stat = stat
+        self.index = None # set by finalize_col_specs
+
+
+def finalize_col_specs(col_specs, has_stddev):
+    """
+    Set the csv column index of each column specification, once it is known
+    whether the csv file has stddev columns
+    """
+    global NUM_STATS
+    global HAS_STDDEV
+    HAS_STDDEV = has_stddev
+    NUM_STATS = 4 if has_stddev else 3
+    for col in col_specs:
+        measurement_offset = 1 + NUM_STATS * OFFSET_MEASUREMENTS[col.measurement]
+        col.index = measurement_offset + OFFSET_STATS[col.stat]
 
-    def get_index(self):
-        measurement_offset = 1 + NUM_STATS * OFFSET_MEASUREMENTS[self.measurement]
-        return measurement_offset + OFFSET_STATS[self.stat]
+
+def read_csv_rows(f_obj):
+    """
+    Read the non-empty rows of a csv file. The result files written by benchy
+    have no quoted fields, so lines are simply split on ','; the csv module is
+    only used for lines that contain quotes.
+    """
+    rows = []
+    for line in f_obj:
+        line = line.rstrip('\r\n')
+        if not line:
+            continue
+        if '"' in line:
+            row = next(csv.reader([line], delimiter=',', skipinitialspace=True))
+        else:
+            row = line.split(',')
+            if ' ' in line:
+                row = [cell.lstrip(' ') for cell in row]
+        rows.append(row)
+    return rows
 
 
 def get_csv_fields(csv_file, col_specs):
     """
     Get the data in columns indicated by the column specifications
     """
-    global NUM_STATS
-    global HAS_STDDEV
-    plotlines = None
-    with open(csv_file) as f_obj:
-        reader = csv.reader(f_obj, delimiter=',', skipinitialspace=True)
-        header = None
-        for row in reader:
-            if len(row) == 0:
-                continue
-
-            if plotlines is None:
-                # handle header row (first iteration only)
-                header = row
-                for col_header in header:
-                    if COL_STDDEV in col_header.lower():
-                        NUM_STATS = 4
-                        HAS_STDDEV = True
-                        break
-                plotlines = []
-                for col in col_specs:
-                    ylabel = row[col.get_index()]
-                    tmp = ylabel.lower()
-                    if col.measurement not in tmp or col.stat not in tmp:
-                        exit_with_error("Corrupt csv file '" + csv_file + "'? "
-                                        "Invalid column header '" + ylabel + "'.")
-
-                    plotlines.append(PlotLine(ylabel))
-                continue
-
-            xtick_label = row[COL_BENCHMARK_NAME_OFFSET]
-            for (col, plotline) in zip(col_specs, plotlines):
-                if row[col.get_index()] == "":
-                    continue
-                data_value = float(row[col.get_index()])
-                stddev_value = None
-                if plotline.isMean:
-                    stddev_ind = col.get_index() + OFFSET_STATS[COL_STDDEV]
-                    if stddev_ind < len(row) and HAS_STDDEV:
-                        stddev_value = float(row[stddev_ind])
-                plotline.append(data_value, xtick_label, stddev_value)
+    # a large buffer reduces the number of read() calls on big result files;
+    # newline='' as required by the csv module
+    with open(csv_file, newline='', buffering=CSV_BUFFER_SIZE) as f_obj:
+        rows = read_csv_rows(f_obj)
+    if len(rows) == 0:
+        exit_with_error("Corrupt csv file '" + csv_file + "'? No header found.")
+
+    header = rows[0]
+    body = rows[1:]
+    has_stddev = any(COL_STDDEV in col_header.lower() for col_header in header)
+    finalize_col_specs(col_specs, has_stddev)
+
+    # the x tick labels are the same for all columns, so derive them only once
+    xtick_labels = [get_xtick_label(row[COL_BENCHMARK_NAME_OFFSET]) for row in body]
+
+    stddev_offset = OFFSET_STATS[COL_STDDEV]
+
+    plotlines = []
+    for col in col_specs:
+        ind = col.index
+        ylabel = header[ind]
+        tmp = ylabel.lower()
+        if col.measurement not in tmp or col.stat not in tmp:
+            exit_with_error("Corrupt csv file '" + csv_file + "'? "
+                            "Invalid column header '" + ylabel + "'.")
+
+        # slice out the whole column and convert it at once into a preallocated
+        # array (numpy parses the strings in C); rows which have no value in
+        # this column are skipped
+        values = [row[ind] for row in body]
+        rows_with_value = body
+        plotline_xtick_labels = xtick_labels
+        if "" in values:
+            rows_with_value = [row for row in body if row[ind] != ""]
+            values = [row[ind] for row in rows_with_value]
+            plotline_xtick_labels = [get_xtick_label(row[COL_BENCHMARK_NAME_OFFSET])
+                                     for row in rows_with_value]
+        plotline = PlotLine(ylabel, len(values))
+        plotline.data[:] = values
+        plotline.xtick_labels = plotline_xtick_labels
+        if plotline.isMean and has_stddev:
+            stddev_ind = ind + stddev_offset
+            stddev = [row[stddev_ind] for row in rows_with_value
+                      if stddev_ind < len(row)]
+            plotline.stddev = np.empty(len(stddev), dtype=np.float64)
+            plotline.stddev[:] = stddev
+        plotlines.append(plotline)
 
     return plotlines
 
 
-def percentile(values, percent):
+def get_cache_file(csv_file, col_specs):
     """
-    Find the percentile of a list of values.
-    Code adapted from https://stackoverflow.com/a/2753343
-    @parameter values - is a list of values.
-    @parameter percent - a float value from 0.0 to 1.0.
-    @return - the percentile of the values
+    Get the cache file for the given columns of a csv file; it changes whenever
+    the csv file is modified
     """
-    if not values:
-        return None
-    values.sort()
-    k = (len(values)-1) * percent
-    f = math.floor(k)
-    c = math.ceil(k)
-    if f == c:
-        return values[int(k)]
-    d0 = values[int(f)] * (c-k)
-    d1 = values[int(c)] * (k-f)
-    return d0+d1
+    st = os.stat(csv_file)
+    cols = ",".join(col.measurement + ":" + col.stat for col in col_specs)
+    key = "{}:{}:{}:{}:{}".format(CACHE_VERSION, os.path.abspath(csv_file),
+                                  st.st_mtime_ns, st.st_size, cols)
+    return os.path.join(CACHE_DIR, hashlib.md5(key.encode()).hexdigest() + ".pkl")
+
+
+def load_csv_fields(csv_file, col_specs, use_cache=True):
+    """
+    Get the data in columns indicated by the column specifications, reusing
+    the result of a previous run if the csv file has not changed since
+    """
+    if not use_cache:
+        return get_csv_fields(csv_file, col_specs)
+
+    cache_file = get_cache_file(csv_file, col_specs)
+    try:
+        with open(cache_file, 'rb') as f_obj:
+            return pickle.load(f_obj)
+    except (OSError, EOFError, AttributeError, ImportError, pickle.UnpicklingError):
+        pass # missing or unusable cache file
+
+    plotlines = get_csv_fields(csv_file, col_specs)
+    tmp_file = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        # dump into a temporary file first, so that a failed dump never leaves
+        # a partial cache file behind
+        (fd, tmp_file) = tempfile.mkstemp(suffix=".tmp", dir=CACHE_DIR)
+        with os.fdopen(fd, 'wb') as f_obj:
+            pickle.dump(plotlines, f_obj, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+        tmp_file = None
+    except (OSError, pickle.PicklingError):
+        pass # caching is best effort only
+    finally:
+        if tmp_file is not None:
+            try:
+                os.remove(tmp_file)
+            except OSError:
+                pass
+    return plotlines
 
 
 def plot_data(files, col_specs, data_labels, xlabel, ylabel, title,
               xtick_labels, out_file, legend_title, xtick_legend, chart_type,
-              yscale):
+              yscale, use_cache=True):
     """
     Generate plot.
     """
+    if out_file:
+        # the plot is only saved, so avoid initializing an interactive backend
+        plt.switch_backend("Agg")
+
     fontname = "cmr10"
     fontsize = 22
     fontsize_axis = 18
     fontsize_legend = 16
     fontsize_ticks = 14
-    font = {'family': fontname, 'size': fontsize_legend}
-    matplotlib.rc('font', **font)
-
-    def correct_font(x, fontsize=fontsize):
-        x.set_fontsize(fontsize)
-        x.set_fontname(fontname)
+    # fonts are applied as the artists are created, and only for this plot
+    plot_rc = {
+        'font.family': fontname,
+        'font.size': fontsize_legend,
+        'figure.titlesize': fontsize,
+        'axes.titlesize': fontsize_axis,
+        'axes.labelsize': fontsize_axis,
+        'ytick.labelsize': fontsize_ticks,
+        'legend.fontsize': fontsize_legend,
+    }
 
     def fix_underscores(s, r=' '):
         return s.replace('_', r)
@@ -183,7 +269,7 @@ def plot_data(files, col_specs, data_labels, xlabel, ylabel, title,
     all_plotlines = None
     subplot_count = 1
     for f in files:
-        plotlines = get_csv_fields(f, col_specs)
+        plotlines = load_csv_fields(f, col_specs, use_cache)
         if all_plotlines is None:
             all_plotlines = [[plotline] for plotline in plotlines]
             subplot_count = len(plotlines)
@@ -195,118 +281,129 @@ def plot_data(files, col_specs, data_labels, xlabel, ylabel, title,
             for (data, plotline) in zip(all_plotlines, plotlines):
                 data.append(plotline)
 
-    # plot data
-    n = len(data_labels)
-    nrows = 6
-    if subplot_count == 2:
-        nrows = 8
-    elif subplot_count == 3:
-        nrows = 10
-    ncols = max(8, len(xtick_labels)/1.5)
-    plt.figure(figsize=(ncols, nrows))
-    ax = None
-    curr_ax = None
-    for i in range(subplot_count):
-        if ax is None:
-            ax = plt.subplot(subplot_count, 1, i + 1)
-            curr_ax = ax
-        else:
-            curr_ax = plt.subplot(subplot_count, 1, i + 1, sharex=ax)
+    with plt.rc_context(plot_rc):
+        # plot data
+        n = len(data_labels)
+        nrows = 6
+        if subplot_count == 2:
+            nrows = 8
+        elif subplot_count == 3:
+            nrows = 10
+        ncols = max(8, len(xtick_labels)/1.5)
+        fig, axes = plt.subplots(subplot_count, 1, sharex=True, squeeze=False,
+                                 figsize=(ncols, nrows))
+        axes = axes[:, 0]
+        ax = axes[0]
+
+        x_ind = np.arange(len(xtick_labels))
+        bar_width = 0.8 / n
+        # bars of the different files are placed side by side around each x tick
+        bar_offsets = (np.arange(n) - (n - 1) / 2) * bar_width
 
-        plotlines = all_plotlines[i]
+        def plot_bar(curr_ax, p, stddev, label, color, bar_offset):
+            curr_ax.bar(x_ind + bar_offset, p.data, bar_width, label=label, yerr=stddev)
 
-        bar_width = 0.8 / n
-        bar_offset = 0 - (n - 1) * (bar_width / 2)
-
-        for (p, label, color) in zip(plotlines, data_labels, COLORS):
-            stddev = None
-            if len(p.stddev) > 0:
-                stddev = p.stddev
-            if chart_type == "bar":
-                ind = [x+bar_offset for x in range(len(xtick_labels))]
-                plt.bar(ind, p.data, bar_width, label=label, yerr=stddev)
-            else:
-                plt.errorbar(range(len(xtick_labels)), p.data, stddev, label=label,
+        def plot_line(curr_ax, p, stddev, label, color, bar_offset):
+            curr_ax.errorbar(x_ind, p.data, stddev, label=label,
                              marker='.', lw=1.0, markersize=9, color=color,
                              linestyle='-')
-            bar_offset += bar_width
 
-            if subplot_count == 1:
-                correct_font(plt.ylabel(p.ylabel), fontsize_axis)
+        def plot_lines(curr_ax, series):
+            # without error bars, all series are drawn as plain lines in one call
+            curr_ax.set_prop_cycle(color=[color for (_, _, color, _) in series])
+            data = np.column_stack([p.data for (p, _, _, _) in series])
+            lines = curr_ax.plot(x_ind, data, marker='.', lw=1.0, markersize=9,
+                                 linestyle='-')
+            for (line, (_, label, _, _)) in zip(lines, series):
+                line.set_label(label)
+
+        if chart_type == "bar":
+            plot_fn = plot_bar
+            grid_args = {"axis": "y", "alpha": 0.4}
+        else:
+            plot_fn = plot_line
+            grid_args = {}
+
+        for (curr_ax, plotlines) in zip(axes, all_plotlines):
+            series = list(zip(plotlines, data_labels, COLORS, bar_offsets))
+            if plot_fn is plot_line and len(series) > 0 and \
+               all(len(p.stddev) == 0 and len(p.data) == len(x_ind)
+                   for (p, _, _, _) in series):
+                plot_lines(curr_ax, series)
             else:
-                correct_font(curr_ax.set_title(p.ylabel), fontsize_axis)
+                for (p, label, color, bar_offset) in series:
+                    stddev = None
+                    if len(p.stddev) > 0:
+                        stddev = p.stddev
+                    plot_fn(curr_ax, p, stddev, label, color, bar_offset)
 
-            if chart_type == "bar":
-                plt.grid(True, axis="y", alpha=0.4)
+            if subplot_count == 1:
+                curr_ax.set_ylabel(plotlines[0].ylabel)
             else:
-                plt.grid(True)
-
-        for tick in curr_ax.yaxis.get_major_ticks():
-            correct_font(tick.label, fontsize_ticks)
-
-        if i < subplot_count - 1:
-            # make these tick labels invisible
-            plt.setp(curr_ax.get_xticklabels(), visible=False)
-
-    if yscale == "symlog":
-        alldata = []
-        for plotlines in all_plotlines:
-            for p in plotlines:
-                alldata.extend(p.data)
-        perc = percentile(alldata, 0.8)
-        ax.set_yscale(yscale, linthreshy=perc)
-        ax.axhline(perc, linewidth=1, alpha=0.4)
-        ax.set_yticks([perc], minor=True)
-        ax.set_yticklabels(["log $\\uparrow$\n" + str(perc) + "\nlin $\\downarrow$"], minor=True, fontsize=fontsize_ticks)
-    else:
-        ax.set_yscale(yscale)
-
-    # set labels, title and legend
-    correct_font(plt.xlabel(xlabel), fontsize_axis)
-    if title:
-        correct_font(plt.suptitle(fix_underscores(title)))
-    if xtick_legend:
-        xtick_legend = xtick_legend.replace(";", "\n")
-        plt.figtext(0.93, 0.12, xtick_legend, fontsize=fontsize_ticks-2, family="monospace",
-            bbox={"facecolor":"orange", "alpha":0.5, "pad":5})
-
-    legend_colls = 2 if len(files) > 4 else 1
-    ax.legend(loc='best', ncol=legend_colls, title=legend_title,
-              fontsize=fontsize_legend)
-
-    max_xtick_label_len = 0
-    for lbl in xtick_labels:
-        max_xtick_label_len = max(max_xtick_label_len, len(lbl))
-    rotation = 0
-    if max_xtick_label_len > 20:
-        rotation = 80
-    elif max_xtick_label_len > 15:
-        rotation = 75
-    elif max_xtick_label_len > 10:
-        rotation = 70
-    elif max_xtick_label_len > 5:
-        rotation = 65
-    plt.xticks(range(len(xtick_labels)), xtick_labels, rotation=rotation)
-
-    # plt.tight_layout()
-    if out_file:
-        plt.savefig(out_file, bbox_inches='tight')
-    else:
-        plt.show()
+                curr_ax.set_title(plotlines[0].ylabel)
+
+            curr_ax.grid(True, **grid_args)
+
+        if yscale == "symlog":
+            alldata = np.concatenate([p.data for plotlines in all_plotlines
+                                      for p in plotlines])
+            perc = np.percentile(alldata, 80)
+            ax.set_yscale(yscale, linthreshy=perc)
+            ax.axhline(perc, linewidth=1, alpha=0.4)
+            ax.set_yticks([perc], minor=True)
+            ax.set_yticklabels(["log $\\uparrow$\n" + str(perc) + "\nlin $\\downarrow$"], minor=True)
+        else:
+            ax.set_yscale(yscale)
+
+        # set labels, title and legend
+        axes[-1].set_xlabel(xlabel)
+        if title:
+            fig.suptitle(fix_underscores(title))
+        if xtick_legend:
+            xtick_legend = xtick_legend.replace(";", "\n")
+            fig.text(0.93, 0.12, xtick_legend, fontsize=fontsize_ticks-2, family="monospace",
+                bbox={"facecolor":"orange", "alpha":0.5, "pad":5})
+
+        legend_colls = 2 if len(files) > 4 else 1
+        ax.legend(loc='best', ncol=legend_colls, title=legend_title)
+
+        max_xtick_label_len = 0
+        for lbl in xtick_labels:
+            max_xtick_label_len = max(max_xtick_label_len, len(lbl))
+        rotation = 0
+        if max_xtick_label_len > 20:
+            rotation = 80
+        elif max_xtick_label_len > 15:
+            rotation = 75
+        elif max_xtick_label_len > 10:
+            rotation = 70
+        elif max_xtick_label_len > 5:
+            rotation = 65
+        axes[-1].set_xticks(range(len(xtick_labels)))
+        axes[-1].set_xticklabels(xtick_labels, rotation=rotation)
+
+        # plt.tight_layout()
+        if out_file:
+            fig.savefig(out_file, bbox_inches='tight')
+        else:
+            plt.show()
 
 
 def get_argument_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--files",
-        help="comma-separated list of CSV files, e.g. file1,file2,...")
+        help="comma-separated list of CSV files, e.g. file1,file2,...",
+        type=get_list_arg)
     parser.add_argument("--columns",
         help="specification of the data columns to be extracted from each file \
               as comma-separated values of the format \
               [(all|time|memory|cpu)[:(mean|median|min)]]. By default the first \
               part is 'all' and the second is 'mean'.",
+        type=parse_column_specs,
         default="all:mean")
     parser.add_argument("--data-labels",
         help="manually list the labels for the legend, separated by ','.",
+        type=get_list_arg,
         default=None)
     parser.add_argument("--xlabel",
         help="x axis label.",
@@ -319,6 +416,7 @@ def get_argument_parser():
         default="linear")
     parser.add_argument("--xtick-labels",
         help="custom tick labels for the X axis, comma-separated.",
+        type=get_list_arg,
         default=None)
     parser.add_argument("--xtick-legend",
         help="legend for the X axis ticks, as ';' separated strings.")
@@ -333,6 +431,10 @@ def get_argument_parser():
     parser.add_argument("-o", "--outfile",
         help="file name for saving the plot.",
         default="plot.png")
+    parser.add_argument("--no-cache",
+        help="do not cache the parsed csv files in $XDG_CACHE_HOME/benchplot \
+              (~/.cache/benchplot by default).",
+        action="store_true")
     return parser
 
 
@@ -374,15 +476,16 @@ if __name__ == "__main__":
     args = parser.parse_args()
     check_args(args)
 
-    plot_data(get_list_arg(args.files),
-              parse_column_specs(args.columns),
-              get_list_arg(args.data_labels),
+    plot_data(args.files,
+              args.columns,
+              args.data_labels,
               args.xlabel,
               args.ylabel,
               args.title,
-              get_list_arg(args.xtick_labels),
+              args.xtick_labels,
               args.outfile,
               args.legend_title,
               args.xtick_legend,
               args.chart_type,
-              args.yscale)
+              args.yscale,
+              not args.no_cache)